@@ -1,15 +1,33 @@
 import shutil
+import errno
+import functools
 import os
 import json
 import sys
 import subprocess
-import tempfile
+import tarfile
 import platform
 import re
 import pathlib
+from concurrent.futures import ThreadPoolExecutor
 
 from platformio.package.manager.tool import ToolPackageManager
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pefile
+except ImportError:
+    pefile = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 # CMake (> 3.15) and Ninja deps are pulled from PlatformIO Registry
 REQUIRED_PREREQUISITE_APPS = ["cmake", "ninja", "platformio", "gcc", "g++"]
 PIO_PKG_MANAGER = ToolPackageManager()
@@ -20,13 +38,55 @@ BUILD_DIR = os.path.join(os.getcwd(), "build")
 # Folder that will contain built packages
 RESULT_DIR = os.path.join(os.getcwd(), "result")
 
+# Generator used for configuring the project
+CMAKE_GENERATOR = "Ninja"
+
+# Readme files copied to the package, matched case-insensitively
+README_FILES = {"readme.md", "readme.txt"}
+
 # Used for installing local CMake and Ninja
 
 IS_WINDOWS = platform.system().lower().startswith("win")
 
-if IS_WINDOWS:
+# Buffer size used for copying dynamic libraries
+COPY_BUFFER_SIZE = 4 * 1024 * 1024
+
+# Number of parallel jobs used for compiling the project
+BUILD_JOBS = os.cpu_count() or 2
+
+# Optional compiler cache, used only if available in PATH
+COMPILER_LAUNCHER = "ccache"
+# Stable cache folder for CI runs, local runs keep the user's ccache config
+CCACHE_DIR = (
+    os.path.join(os.environ["GITHUB_WORKSPACE"], ".ccache")
+    if os.environ.get("GITHUB_WORKSPACE")
+    else None
+)
+
+# `ldd` is only needed for detecting libraries if `pefile` is not available
+if IS_WINDOWS and not pefile:
     REQUIRED_PREREQUISITE_APPS.append("ldd")
 
+# Matches `KEY:TYPE=VALUE` entries in `CMakeCache.txt`
+CMAKE_CACHE_ENTRY_RE = re.compile(
+    r"^(?P<key>[^#/\s][^:=]*)(?::[^=]*)?=(?P<value>.*)$"
+)
+
+# Matches MSYS-style absolute paths, e.g. `/c/Windows` or `//c/Windows`
+MSYS_DRIVE_PATH_RE = re.compile(r"^/+(?P<drive>[a-zA-Z])/(?P<path>.*)$")
+
+# Matches Cppcheck versions, e.g. `2.14`, `2.14.2` or `v2.14.2`
+CPPCHECK_VERSION_RE = re.compile(r"^v?(\d+)\.(\d+)(?:\.(\d+))?$")
+
+# Prints extra diagnostic messages
+DEBUG = os.environ.get("DEBUG") == "1"
+
+# Matches Windows libraries in the `ldd` output
+LDD_LIBRARY_RE = re.compile(
+    r"^.+(?:dll|DLL) => (?P<lib_path>.*) \((?:.*)\)$", re.MULTILINE
+)
+
+@functools.lru_cache(maxsize=None)
 def is_program_installed(program_name):
     return shutil.which(program_name)
 
@@ -39,50 +99,91 @@ def check_requirements(build_dir):
         cmake_dir = os.path.join(get_piopkg_dir("tool-cmake"), "bin")
     ninja_dir = os.path.join(get_piopkg_dir("tool-ninja"))
     os.environ["PATH"] = os.pathsep.join([cmake_dir, ninja_dir] + [os.environ["PATH"]])
+    # Respected by `cmake --build` regardless of the generator in use
+    os.environ.setdefault("CMAKE_BUILD_PARALLEL_LEVEL", str(BUILD_JOBS))
+    # Needed by the build step too, even if the configuration step is skipped
+    if CCACHE_DIR and get_compiler_launcher():
+        os.environ.setdefault("CCACHE_DIR", CCACHE_DIR)
+        os.environ.setdefault("CCACHE_COMPRESS", "1")
+        os.environ.setdefault("CCACHE_MAXSIZE", "2G")
 
     for requirement in REQUIRED_PREREQUISITE_APPS:
         assert is_program_installed(requirement), "'%s' is not installed!" % requirement
 
     for d in (build_dir, RESULT_DIR):
-        if not os.path.isdir(d):
-            os.makedirs(d)
-            assert os.path.isdir(d), "The folder `%s` was not created!"
+        os.makedirs(d, exist_ok=True)
 
     # Clean build directory for the next build
     # if os.path.isdir(build_dir):
     #     shutil.rmtree(build_dir, ignore_errors=False)
 
 
+def get_compiler_launcher():
+    return COMPILER_LAUNCHER if is_program_installed(COMPILER_LAUNCHER) else ""
+
+
 def normalize_binary(binary_name):
     return binary_name + ".exe" if IS_WINDOWS else binary_name
 
 
 def exec_command(args):
-    proc = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = proc.communicate()
-    exitcode = proc.returncode
-    return {"returncode": exitcode, "out": out.decode("utf-8"), "err": err}
+    proc = subprocess.run(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace",
+    )
+    return {"returncode": proc.returncode, "out": proc.stdout, "err": proc.stderr}
+
+
+def exec_command_stream(args):
+    # Output is printed as soon as it's available, so it isn't returned
+    proc = subprocess.Popen(
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        bufsize=1,
+        encoding="utf-8",
+        errors="replace",
+    )
+    with proc.stdout:
+        for line in iter(proc.stdout.readline, ""):
+            print(line, end="", flush=True)
+    exitcode = proc.wait()
+    return {"returncode": exitcode, "out": "", "err": ""}
+
+
+def exec_command_inherit(args):
+    # Output goes straight to the parent's stdout/stderr, so flush ours first
+    sys.stdout.flush()
+    proc = subprocess.run(args)
+    return {"returncode": proc.returncode, "out": "", "err": ""}
 
 
 def validate_exec_command(result, on_err_msg="Failed!"):
     if result["returncode"] != 0:
         print(on_err_msg)
-        print(result["out"])
-        print(result["err"])
+        for output in (result["out"], result["err"]):
+            if output:
+                print(output)
         sys.exit(1)
 
 
+@functools.lru_cache(maxsize=None)
 def get_piopkg_dir(package_name):
-    pkg = PIO_PKG_MANAGER.get_package(package_name)
-    if not pkg:
-        pkg = PIO_PKG_MANAGER.install(package_name)
-
+    pkg = PIO_PKG_MANAGER.get_package(package_name) or PIO_PKG_MANAGER.install(
+        package_name
+    )
     return pkg.path
 
 
-def run_cmake(args=None):
+def run_cmake(args=None, inherit=False):
     args = args or tuple()
-    res = exec_command(("cmake",) + args)
+    if inherit:
+        res = exec_command_inherit(("cmake",) + args)
+    else:
+        res = exec_command_stream(("cmake",) + args)
     validate_exec_command(res, "CMake failed to run with args %s" % " ".join(args))
 
 
@@ -94,7 +195,7 @@ def configure_cmake_project(build_dir, install_dir, cmake_extra_flags=None):
         "-S",
         ".",
         "-G",
-        "Ninja",
+        CMAKE_GENERATOR,
         "-DBUILD_SHARED_LIBS=NO",
         "-DCMAKE_BUILD_TYPE=Release",
         "-DUSE_MATCHCOMPILER=ON",
@@ -103,42 +204,139 @@ def configure_cmake_project(build_dir, install_dir, cmake_extra_flags=None):
         "-DCMAKE_INSTALL_PREFIX:PATH=%s" % install_dir,
     )
 
+    # An empty value resets a launcher left in the cache by a previous run
+    launcher = get_compiler_launcher()
+    if launcher:
+        print("Using `%s` as a compiler launcher" % launcher)
+    cmake_args += (
+        "-DCMAKE_C_COMPILER_LAUNCHER=%s" % launcher,
+        "-DCMAKE_CXX_COMPILER_LAUNCHER=%s" % launcher,
+    )
+
     run_cmake(cmake_args)
 
 
+def read_cmake_cache(build_dir):
+    cache = {}
+    cache_file = os.path.join(build_dir, "CMakeCache.txt")
+    if not os.path.isfile(cache_file):
+        return cache
+
+    with open(cache_file) as fp:
+        for line in fp:
+            match = CMAKE_CACHE_ENTRY_RE.match(line.rstrip("\r\n"))
+            if match:
+                cache[match.group("key")] = match.group("value")
+
+    return cache
+
+
+def needs_reconfigure(build_dir, install_dir):
+    cache = read_cmake_cache(build_dir)
+    # The cache is written even if the configuration fails midway, this file
+    # is written by any generator only after the configuration has finished
+    check_file = os.path.join(build_dir, "CMakeFiles", "cmake.check_cache")
+    if not cache or not os.path.isfile(check_file):
+        return True
+
+    # CMake stores paths with forward slashes even on Windows
+    cached_prefix = cache.get("CMAKE_INSTALL_PREFIX", "")
+    return (
+        os.path.normcase(os.path.normpath(cached_prefix))
+        != os.path.normcase(os.path.normpath(install_dir))
+        or cache.get("CMAKE_GENERATOR") != CMAKE_GENERATOR
+        or any(
+            cache.get("CMAKE_%s_COMPILER_LAUNCHER" % lang, "") != get_compiler_launcher()
+            for lang in ("C", "CXX")
+        )
+    )
+
+
 def install_cppcheck(build_dir):
     print("Building and installing project...")
-    cmake_args = ("--build", build_dir, "--target", "install")
-    run_cmake(cmake_args)
+    cmake_args = ("--build", build_dir, "-j", str(BUILD_JOBS), "--target", "install")
+    run_cmake(cmake_args, inherit=True)
 
 
 def posix2win(path):
-    # quick and dirty way
     if path.startswith("/mingw"):
-        result = pathlib.Path.home().drive + path
+        result = pathlib.Path.home().drive + path.replace("/", "\\")
     else:
-        result = path[1] + ":" + path[2:]
-    print("Converted `%s` to `%s`" % (path, result))
+        match = MSYS_DRIVE_PATH_RE.match(path)
+        # Anything else is expected to be a Windows path already
+        result = (
+            match.group("drive") + ":\\" + match.group("path").replace("/", "\\")
+            if match
+            else path
+        )
+    if DEBUG:
+        print("Converted `%s` to `%s`" % (path, result))
     return result
 
 
+@functools.lru_cache(maxsize=None)
+def get_search_path_libraries():
+    # Dependent DLLs are resolved from the folders listed in PATH
+    libs = {}
+    for folder in os.environ.get("PATH", "").split(os.pathsep):
+        if not os.path.isdir(folder):
+            continue
+        with os.scandir(folder) as it:
+            for entry in it:
+                name = entry.name.lower()
+                if name.endswith(".dll") and name not in libs:
+                    libs[name] = entry.path
+
+    return libs
+
+
+def read_pe_imports(binary_path):
+    pe = pefile.PE(binary_path, fast_load=True)
+    try:
+        pe.parse_data_directories(
+            directories=[pefile.DIRECTORY_ENTRY["IMAGE_DIRECTORY_ENTRY_IMPORT"]]
+        )
+        return [
+            entry.dll.decode() for entry in getattr(pe, "DIRECTORY_ENTRY_IMPORT", [])
+        ]
+    finally:
+        pe.close()
+
+
+def extract_pe_dynamic_libraries(binary_path, allowed_paths):
+    libs = []
+    known_libs = get_search_path_libraries()
+
+    # Walk the import tables recursively, just like `ldd` does
+    pending = [binary_path]
+    visited = set()
+    while pending:
+        for lib_name in read_pe_imports(pending.pop()):
+            lib_name = lib_name.lower()
+            if lib_name in visited:
+                continue
+            visited.add(lib_name)
+
+            lib_path = known_libs.get(lib_name)
+            if lib_path and any(path in lib_path for path in allowed_paths):
+                libs.append(lib_path)
+                pending.append(lib_path)
+
+    return libs
+
+
 def extract_dynamic_libraries(binary_path, allowed_paths=None):
     allowed_paths = allowed_paths or []
     libs = []
 
     assert os.path.isfile(binary_path), "%s binary is not found" % binary_path
+    if pefile:
+        return extract_pe_dynamic_libraries(binary_path, allowed_paths)
+
     res = exec_command(("ldd", binary_path))
     if res["returncode"] == 0:
-        pattern = r"^.+(?:dll|DLL) => (?P<lib_path>.*) \((?:.*)\)$"
-        prog = re.compile(pattern)
-        for line in res["out"].split("\n"):
-            line = line.strip()
-            if not line:
-                continue
-
-            match = prog.match(line)
-            if not match:
-                print("Warning! No libraries were found! in %s" % res["out"])
+        match = None
+        for match in LDD_LIBRARY_RE.finditer(res["out"]):
             lib_path = posix2win(match.group("lib_path"))
             assert os.path.isfile(lib_path), (
                 "Dynamic library `%s` doesn't exit" % lib_path
@@ -147,14 +345,30 @@ def extract_dynamic_libraries(binary_path, allowed_paths=None):
             if any(path in lib_path for path in allowed_paths):
                 libs.append(lib_path)
 
+        if match is None:
+            print("Warning! No libraries were found! in %s" % res["out"])
+
     return libs
 
 
+def copy_lib(src, dst):
+    print("Copying `%s` to `%s`" % (src, dst))
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        shutil.copyfileobj(fsrc, fdst, length=COPY_BUFFER_SIZE)
+
+
 def copy_msys_lib_deps(binary_path, allowed_paths=None):
     dst_path = os.path.dirname(binary_path)
-    for lib_path in extract_dynamic_libraries(binary_path, allowed_paths):
-        print("Copying `%s` to `%s`" % (lib_path, dst_path))
-        shutil.copyfile(lib_path, os.path.join(dst_path, os.path.basename(lib_path)))
+    pairs = [
+        (lib_path, os.path.join(dst_path, os.path.basename(lib_path)))
+        for lib_path in extract_dynamic_libraries(binary_path, allowed_paths)
+    ]
+    if not pairs:
+        return
+
+    # Copying is I/O bound, so it's safe to run it in several threads
+    with ThreadPoolExecutor(max_workers=min(8, len(pairs))) as executor:
+        list(executor.map(lambda pair: copy_lib(*pair), pairs))
 
 
 def prepare_package(install_dir):
@@ -167,18 +381,28 @@ def prepare_package(install_dir):
     assert os.path.isfile(
         binary_path
     ), "Missing cppcheck binary in the installed directory"
-    shutil.move(binary_path, os.path.join(install_dir, binary_name))
+    try:
+        os.replace(binary_path, os.path.join(install_dir, binary_name))
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(binary_path, os.path.join(install_dir, binary_name))
     binary_path = os.path.join(install_dir, binary_name)
 
     # Delete the empty "bin" folder
     shutil.rmtree(os.path.join(install_dir, "bin"), ignore_errors=False)
 
     # copy readme if available
-    for f in os.listdir(os.getcwd()):
-        f = f.lower()
-        if f in ("readme.md", "readme.txt"):
-            shutil.copy(os.path.join(os.getcwd(), f), os.path.join(install_dir, f))
-            break
+    readme = next(
+        (
+            f
+            for f in pathlib.Path.cwd().iterdir()
+            if f.name.lower() in README_FILES
+        ),
+        None,
+    )
+    if readme:
+        shutil.copy(str(readme), os.path.join(install_dir, readme.name.lower()))
 
     if IS_WINDOWS:
         print("Copying MSYS dynamic libraries for Windows")
@@ -187,14 +411,20 @@ def prepare_package(install_dir):
 
 def validate_package(install_dir):
     print("Validating package structure...")
+    binary_name = normalize_binary("cppcheck")
+    binary_path = pathlib.Path(install_dir) / binary_name
+    # Gather the package contents with a single directory scan
+    with os.scandir(install_dir) as it:
+        entries = {entry.name: entry for entry in it}
+
     # Check if binary is available
-    assert os.path.isfile(
-        os.path.join(install_dir, normalize_binary("cppcheck"))
+    assert (
+        binary_name in entries and entries[binary_name].is_file()
     ), "Missing cppcheck binary in the package folder:"
 
     # Check extra folders with scripts and addons
     for folder in ("addons", "cfg", "platforms"):
-        assert os.path.isdir(os.path.join(install_dir, folder)), (
+        assert folder in entries and entries[folder].is_dir(), (
             "%s folder is missing!" % folder
         )
 
@@ -202,15 +432,34 @@ def validate_package(install_dir):
     # assert os.path.isdir(os.path.join(install_dir, "bin"))
 
     # Check PlatformIO Manifest
-    assert os.path.isfile(
-        os.path.join(install_dir, "package.json")
+    assert (
+        "package.json" in entries and entries["package.json"].is_file()
     ), "Missing PlatformIO manifest file"
 
     # Check if binary is alive
-    res = exec_command(
-        [os.path.join(install_dir, normalize_binary("cppcheck")), "--version"]
-    )
-    validate_exec_command(res, "Failed to validate final viable binary")
+    try:
+        out = subprocess.check_output(
+            [str(binary_path), "--version"],
+            timeout=10,
+            stderr=subprocess.STDOUT,
+            encoding="utf-8",
+            errors="replace",
+        )
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+        print("Failed to validate final viable binary")
+        print(e)
+        output = e.output or ""
+        # Partial output of a timed out process may not be decoded
+        if isinstance(output, bytes):
+            output = output.decode("utf-8", errors="replace")
+        if output:
+            print(output)
+        sys.exit(1)
+    except OSError as e:
+        print("Failed to validate final viable binary")
+        print(e)
+        sys.exit(1)
+    print(out.strip())
 
 
 def create_pio_package(package_dir, result_dir):
@@ -228,18 +477,23 @@ def archive_package(package_dir, result_dir):
     print("Preparing an archive package from `%s` to `%s`" % (package_dir, result_dir))
     assert os.path.isdir(package_dir), "Package folder doesn't exist"
 
-    backup_cwd = os.getcwd()
-    os.chdir(package_dir)
-    tar_args = (
-        "tar",
-        "-czf",
-        os.path.join(result_dir, "cppcheck-%s.tar.gz" % get_target_systems()),
-        " ".join(os.listdir(package_dir)),
-    )
-    res = exec_command(tar_args)
-
-    os.chdir(backup_cwd)
-    validate_exec_command(res, "Failed to create an archive package!")
+    archive_name = "cppcheck-%s" % "_".join(get_target_systems())
+    try:
+        if zstandard:
+            archive_path = os.path.join(result_dir, archive_name + ".tar.zst")
+            compressor = zstandard.ZstdCompressor(level=3, threads=-1)
+            with open(archive_path, "wb") as fp:
+                with compressor.stream_writer(fp) as writer:
+                    with tarfile.open(fileobj=writer, mode="w|") as tar:
+                        tar.add(package_dir, arcname=".")
+        else:
+            archive_path = os.path.join(result_dir, archive_name + ".tar.gz")
+            with tarfile.open(archive_path, "w:gz") as tar:
+                tar.add(package_dir, arcname=".")
+    except (OSError, tarfile.TarError) as e:
+        print("Failed to create an archive package!")
+        print(e)
+        sys.exit(1)
 
 
 def get_target_systems():
@@ -257,21 +511,10 @@ def get_target_systems():
 
 def convert_version_to_pio_compatible(version):
     print("Converting `%s` version" % version)
-    version = version.replace("v", "")
-    if version.count(".") == 1:
-        version = version + ".0"
-    major, minor, patch = version.split(".")
-    version = major
-    if len(minor) < 2:
-        version = version + "0" + minor
-    else:
-        version = version + minor
-    if len(patch) < 2:
-        version = version + "0" + patch
-    else:
-        version = version + patch
-
-    return "1." + version + ".0"
+    match = CPPCHECK_VERSION_RE.match(version)
+    assert match, "Unsupported version format `%s`" % version
+    major, minor, patch = (int(value or 0) for value in match.groups())
+    return "1.%d%02d%02d.0" % (major, minor, patch)
 
 
 def extract_version_from_git_env():
@@ -317,8 +560,12 @@ def generate_pio_manifest(result_dir, version, system):
     pkg_manifest = os.path.join(result_dir, "package.json")
 
     manifest_data = get_package_manifeset_data(version, system)
-    with open(pkg_manifest, "w") as fp:
-        json.dump(manifest_data, fp, indent=2)
+    if orjson:
+        with open(pkg_manifest, "wb") as fp:
+            fp.write(orjson.dumps(manifest_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(pkg_manifest, "w") as fp:
+            json.dump(manifest_data, fp, indent=2)
 
 
 def main():
@@ -333,35 +580,40 @@ def main():
         % (pio_pkg_version, ",".join(package_systems))
     )
 
-    with tempfile.TemporaryDirectory() as install_dir:
-        install_dir = os.path.join(
-            os.getcwd(), "cppcheck-built-install-dir-" + "_".join(package_systems)
-        )
-        print("Cppcheck will be installed to '%s'" % install_dir)
+    install_dir = os.path.join(
+        os.getcwd(), "cppcheck-built-install-dir-" + "_".join(package_systems)
+    )
+    print("Cppcheck will be installed to '%s'" % install_dir)
 
-        # Build and prepare package that will be added to the PlatformIO Registry
+    # Build and prepare package that will be added to the PlatformIO Registry
+    if needs_reconfigure(build_dir, install_dir):
         configure_cmake_project(build_dir, install_dir)
-        install_cppcheck(build_dir)
-        prepare_package(install_dir)
+    else:
+        print("CMake cache is up to date, skipping configuration step")
+    install_cppcheck(build_dir)
+    prepare_package(install_dir)
 
-        # # Generate PlatformIO-specific files
-        generate_pio_manifest(install_dir, pio_pkg_version, package_systems)
+    # # Generate PlatformIO-specific files
+    generate_pio_manifest(install_dir, pio_pkg_version, package_systems)
 
-        # Make sure package is working and ready to be archived
-        validate_package(install_dir)
+    # Make sure package is working and ready to be archived
+    validate_package(install_dir)
 
-        # Archive the package
-        # archive_package(install_dir, RESULT_DIR)
+    # Archive the package
+    # archive_package(install_dir, RESULT_DIR)
 
-        # Or Make a PlatformIO package
-        create_pio_package(install_dir, RESULT_DIR)
+    # Or Make a PlatformIO package
+    create_pio_package(install_dir, RESULT_DIR)
 
-        assert os.path.isfile(
-            os.path.join(
-                RESULT_DIR,
-                "tool-cppcheck-%s-%s.tar.gz" % (package_systems[0], pio_pkg_version),
-            )
-        ), "The final PlatformIO package is missing!"
+    assert os.path.isfile(
+        os.path.join(
+            RESULT_DIR,
+            "tool-cppcheck-%s-%s.tar.gz" % (package_systems[0], pio_pkg_version),
+        )
+    ), "The final PlatformIO package is missing!"
+
+    # Only reached on success, a failed run keeps the folder for debugging
+    shutil.rmtree(install_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":